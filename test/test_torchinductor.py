@@ -1,9 +1,12 @@
 #!/usr/bin/env pytest
+import collections
 import contextlib
 import dataclasses
 import functools
 import importlib
+import operator
 import random
+import re
 import unittest
 from unittest.mock import patch
 
@@ -27,6 +30,8 @@ try:
 
     import torchinductor.config
     from torchinductor import config
+    from torchinductor.codecache import PyCodeCache
+    from torchinductor.codegen.wrapper import hash_constant
     from torchinductor.compile_fx import compile_fx
     from torchinductor.ir import IndexingDiv
     from torchinductor.ir import ModularIndexing
@@ -228,6 +233,50 @@ def check_model_cuda(
         check_model(self, model, example_inputs, 2e-3, exact_dtype=exact_dtype)
 
 
+def run_and_get_wrapper_code(self: TestCase, model, example_inputs):
+    """
+    Check model with self.common() and return the generated wrapper code
+    """
+    source_codes = []
+    load = PyCodeCache.load
+
+    def record_load(source_code):
+        source_codes.append(source_code)
+        return load(source_code)
+
+    with patch.object(PyCodeCache, "load", record_load):
+        self.common(model, example_inputs, check_lowp=False)
+    return "\n".join(source_codes)
+
+
+def wrapper_peak_bytes(code):
+    """
+    Largest sum of the storage live at any line of static shape wrapper code
+    """
+    live = {}
+    peak = 0
+    for line in code.splitlines():
+        line = line.strip()
+        alloc = re.match(
+            r"(\w+) = empty_strided\(\(([\d, ]*)\), .*dtype=torch\.(\w+)\)$", line
+        )
+        reuse = re.match(r"(\w+) = (?:as_strided\()?(\w+)\b.*; del \2$", line)
+        if alloc:
+            name, size, dtype = alloc.groups()
+            numel = functools.reduce(
+                operator.mul, [int(s) for s in size.split(",") if s.strip()], 1
+            )
+            itemsize = torch.empty((), dtype=getattr(torch, dtype)).element_size()
+            live[name] = numel * itemsize
+        elif reuse:
+            new, old = reuse.groups()
+            live[new] = live.pop(old, 0)
+        elif line.startswith("del "):
+            live.pop(line[len("del ") :], None)
+        peak = max(peak, sum(live.values()))
+    return peak
+
+
 class SweepInputs2:
     input_gen_types1 = [
         "dense",
@@ -2833,6 +2882,121 @@ class CommonTemplate:
             )
         self.assertEqual(torchinductor.metrics.generated_kernel_count, expected_kernel)
 
+    def test_hash_constant(self):
+        a = torch.zeros(10000, device=self.device)
+        b = a.clone()
+        b[5000] = 1
+        # repr() of both is identical, the hash has to see the middle
+        self.assertNotEqual(hash_constant(a), hash_constant(b))
+        self.assertEqual(hash_constant(a), hash_constant(a.clone()))
+        with patch.object(config, "sha256_constant_hash", True):
+            self.assertNotEqual(hash_constant(a), hash_constant(b))
+
+    def test_buffer_reuse_min_bytes(self):
+        def fn(a, b):
+            c = torch.mm(a, b).sin()
+            d = torch.mm(c, b).cos()
+            return (torch.mm(d, b),)
+
+        args = (torch.randn([8, 8]), torch.randn([8, 8]))
+        # 8x8 float32 buffers are smaller than the default reuse_min_bytes
+        code = run_and_get_wrapper_code(self, fn, args)
+        self.assertNotIn("# reuse", code)
+        self.assertIn("del buf", code)
+
+        with patch.object(config, "reuse_min_bytes", 0):
+            code = run_and_get_wrapper_code(self, fn, args)
+        self.assertIn("# reuse", code)
+
+    @patch.object(config, "reuse_min_bytes", 0)
+    def test_buffer_reuse_pool_size(self):
+        def fn(a, b, c):
+            x = torch.mm(a, b)
+            y = torch.mm(a, c)
+            s = x + y
+            # x and y are both freed before these two allocations
+            return (torch.mm(s, b) + torch.mm(s, c),)
+
+        args = (torch.randn([8, 8]), torch.randn([8, 8]), torch.randn([8, 8]))
+        code = run_and_get_wrapper_code(self, fn, args)
+        with patch.object(config, "reuse_pool_size", 1):
+            small_pool_code = run_and_get_wrapper_code(self, fn, args)
+        # with a single entry per key the older of x and y falls out of the pool
+        self.assertLess(small_pool_code.count("# reuse"), code.count("# reuse"))
+
+    @patch.object(config, "dynamic_shapes", False)
+    def test_memory_planning_coloring(self):
+        def fn(a, b):
+            c = torch.mm(a, b)
+            d = torch.mm(c, b.t())
+            e = torch.mm(d, b)
+            return (torch.mm(e, b.t()),)
+
+        args = (torch.randn([8, 16]), torch.randn([16, 32]))
+        code = run_and_get_wrapper_code(self, fn, args)
+        with patch.object(config, "memory_planning", "coloring"):
+            coloring_code = run_and_get_wrapper_code(self, fn, args)
+        # c is freed right before e is allocated, so the two 8x32 buffers
+        # share an arena and no other allocation sees it idle
+        self.assertEqual(coloring_code.count("arena0 = empty_strided((1024, )"), 1)
+        self.assertEqual(coloring_code.count("as_strided(arena0[:1024]"), 2)
+        self.assertEqual(coloring_code.count("del arena0"), 1)
+        self.assertNotIn("arena1", coloring_code)
+        self.assertLessEqual(
+            wrapper_peak_bytes(coloring_code), wrapper_peak_bytes(code)
+        )
+
+    @patch.object(config, "dynamic_shapes", False)
+    def test_memory_planning_coloring_peak(self):
+        def fn(a, b, c, d, e):
+            w = torch.mm(a, b)  # 1024 bytes, freed before x and y exist
+            v = torch.mm(w, c)
+            x = torch.mm(v, d)  # 512 bytes
+            y = torch.mm(x, e)  # 512 bytes, overlaps x
+            return (torch.mm(y, e),)
+
+        args = (
+            torch.randn([8, 16]),
+            torch.randn([16, 32]),
+            torch.randn([32, 8]),
+            torch.randn([8, 16]),
+            torch.randn([16, 16]),
+        )
+        code = run_and_get_wrapper_code(self, fn, args)
+        with patch.object(config, "memory_planning", "coloring"):
+            coloring_code = run_and_get_wrapper_code(self, fn, args)
+        # putting x in w's arena would keep 1024 bytes reserved while y is
+        # allocated, and y would need a second arena on top of that
+        self.assertLessEqual(
+            wrapper_peak_bytes(coloring_code), wrapper_peak_bytes(code)
+        )
+
+    @patch.object(config, "memory_planning", "coloring")
+    @patch.object(config, "dynamic_shapes", False)
+    def test_memory_planning_coloring_dtypes(self):
+        def fn(a, b):
+            c = torch.mm(a, b).sin()
+            d = torch.mm(c.double(), b.double().t()).cos()
+            e = torch.mm(d.float(), b).sin()
+            return (torch.mm(e, b.t()),)
+
+        code = run_and_get_wrapper_code(
+            self, fn, (torch.randn([8, 16]), torch.randn([16, 32]))
+        )
+        arena_dtypes = collections.defaultdict(set)
+        for arena, dtype in re.findall(
+            r"as_strided\((arena\d+)\[:\w+\]\.view\((torch\.\w+)\)", code
+        ):
+            arena_dtypes[arena].add(dtype)
+        # float32 and float64 buffers with disjoint lifetimes share an arena
+        self.assertTrue(
+            any(
+                {"torch.float32", "torch.float64"} <= dtypes
+                for dtypes in arena_dtypes.values()
+            ),
+            arena_dtypes,
+        )
+
     @patch.object(config.triton, "cudagraphs", False)
     def test_lowmem_dropout1(self):
         n = 100000
@@ -221,17 +221,21 @@ class IndentedBuffer:
     def prefix(self):
         return " " * (self._indent * self.tabwidth)
 
-    def writeline(self, line):
+    def _append(self, line, prefix):
         if isinstance(line, DeferredLine):
-            self._lines.append(line.with_prefix(self.prefix()))
+            self._lines.append(line.with_prefix(prefix))
         elif line.strip():
-            self._lines.append(f"{self.prefix()}{line}")
+            self._lines.append(f"{prefix}{line}")
         else:
             self._lines.append("")
 
+    def writeline(self, line):
+        self._append(line, self.prefix())
+
     def writelines(self, lines):
+        prefix = self.prefix()
         for line in lines:
-            self.writeline(line)
+            self._append(line, prefix)
 
     def indent(self, offset=1):
         @contextlib.contextmanager
@@ -1,16 +1,29 @@
+import bisect
 import collections
 import dataclasses
+import functools
 import hashlib
 from itertools import count
 from typing import Any
+from typing import Deque
 from typing import Dict
 from typing import List
+from typing import Optional
+
+import sympy
+import torch
+
+try:
+    import xxhash
+except (ImportError, ModuleNotFoundError):
+    xxhash = None
 
 from torchdynamo.utils import dynamo_timed
 
 from .. import codecache
 from .. import config
 from .. import ir
+from ..utils import cache_on_self
 from ..utils import has_triton
 from ..utils import sympy_product
 from ..virtualized import V
@@ -23,23 +36,35 @@ from .triton import texpr
 pexpr = texpr
 
 
+@cache_on_self
 def buffer_reuse_key(node: ir.Buffer):
+    # sympy already canonicalizes a product of sizes as it builds it, which
+    # is all an equality key needs.  Skipping sizevars.simplify() (expand +
+    # replacements) can only miss a reuse, never produce a wrong one.
     return (
         node.get_device(),
         node.get_dtype(),
-        V.graph.sizevars.simplify(sympy_product(node.get_size())),
+        sympy_product(node.get_size()),
     )
 
 
 def make_buffer_reuse(old, new):
     assert old.get_dtype() == new.get_dtype()
-    if old.get_size() == new.get_size() and old.get_stride() == new.get_stride():
-        return f"{new.get_name()} = {old.get_name()}; del {old.get_name()}"
+    old_name = old.get_name()
+    new_name = new.get_name()
+    old_size, new_size = old.get_size(), new.get_size()
+    old_stride, new_stride = old.get_stride(), new.get_stride()
+    # identity check first, layouts often share their size/stride lists
+    # and comparing sympy expressions element by element is slow
+    if (old_size is new_size or old_size == new_size) and (
+        old_stride is new_stride or old_stride == new_stride
+    ):
+        return f"{new_name} = {old_name}; del {old_name}"
 
     return (
-        f"{new.get_name()} = as_strided({old.get_name()}, "
-        f"{V.graph.sizevars.codegen_shape_tuple(new.get_size())}, "
-        f"{V.graph.sizevars.codegen_shape_tuple(new.get_stride())}); del {old.get_name()}"
+        f"{new_name} = as_strided({old_name}, "
+        f"{V.graph.sizevars.codegen_shape_tuple(new_size)}, "
+        f"{V.graph.sizevars.codegen_shape_tuple(new_stride)}); del {old_name}"
     )
 
 
@@ -56,110 +81,475 @@ def make_buffer_allocation(buffer):
     )
 
 
+@functools.lru_cache(None)
+def dtype_size(dtype: torch.dtype) -> int:
+    return torch.empty((), dtype=dtype).element_size()
+
+
+@cache_on_self
+def buffer_nbytes_hint(node: ir.Buffer) -> int:
+    _, dtype, numel = buffer_reuse_key(node)
+    return V.graph.sizevars.size_hint(numel) * dtype_size(dtype)
+
+
+def buffer_storage_nbytes(node: ir.Buffer):
+    """Bytes of storage empty_strided() needs for node"""
+    size = node.get_size()
+    if any(s == 0 for s in size):
+        return sympy.Integer(0)
+    extent = 1 + sum((s - 1) * st for s, st in zip(size, node.get_stride()))
+    return V.graph.sizevars.simplify(extent * dtype_size(node.get_dtype()))
+
+
+def device_checksum(data: torch.Tensor):
+    """
+    Reduce the flat uint8 tensor data to two int64 sums on its own device,
+    so only those are copied to the host.  Every 8-byte word gets an odd
+    weight, so changing any single element always changes the checksum.
+    """
+    pad = -data.numel() % 8
+    if pad:
+        data = torch.cat([data, data.new_zeros(pad)])
+    words = data.view(torch.int64)
+    weights = torch.arange(words.numel(), device=data.device, dtype=torch.int64)
+    weights = (weights * -7046029254386353131) | 1
+    return torch.stack([words.sum(), (words * weights).sum()]).tolist()
+
+
+def hash_constant(value: torch.Tensor):
+    """
+    Hash the contents of a constant.  repr() only shows the edges of large
+    tensors, so constants differing in the middle would share a module.
+    """
+    data = value.detach().contiguous().reshape(-1).view(torch.uint8)
+    if xxhash is not None and not config.sha256_constant_hash:
+        hasher = xxhash.xxh3_64()
+    else:
+        hasher = hashlib.sha256()
+    hasher.update(f"{value.dtype} {tuple(value.size())}\n".encode("utf-8"))
+    if data.device.type == "cpu":
+        hasher.update(memoryview(data.numpy()))
+    elif config.sha256_constant_hash:
+        hasher.update(memoryview(data.cpu().numpy()))
+    else:
+        hasher.update(repr(device_checksum(data)).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+@functools.lru_cache(None)
+def wrapper_header(triton: bool, triton_conv: bool, triton_mm: bool, triton_bmm: bool):
+    """
+    Imports at the top of the wrapper, these only depend on a few config
+    options so build the text once per combination of them
+    """
+    header = IndentedBuffer()
+    header.splice(
+        f"""
+            from ctypes import c_void_p, c_long
+            import torch
+            import random
+            from torch import empty_strided, as_strided, device
+            from {codecache.__name__} import CppCodeCache, TritonCodeCache
+
+            aten = torch.ops.aten
+
+        """
+    )
+
+    if triton:
+        header.splice(
+            """
+                import triton
+                import triton.language as tl
+
+                from torchinductor.triton_ops.autotune import pointwise_heuristics
+                from torchinductor.triton_ops.autotune import reduction_heuristics
+                from torchinductor.triton_ops.autotune import grid
+
+            """
+        )
+
+        if triton_conv:
+            header.splice(
+                """
+                from torchinductor.triton_ops.conv_perf_model import early_config_prune
+                from torchinductor.triton_ops.conv_perf_model import estimate_conv_time
+                from torchinductor.triton_ops.autotune import conv_heuristics
+                """
+            )
+
+        if triton_mm:
+            header.splice(
+                """
+                from torchinductor.triton_ops.autotune import mm_heuristics
+                from torchinductor.triton_ops.autotune import mm_autotune
+                """
+            )
+
+        if triton_bmm:
+            header.writeline(
+                "from torchinductor.triton_ops.batched_matmul import bmm_out as triton_bmm_out"
+            )
+    return header.getvalue()
+
+
 class MemoryPlanningState:
     def __init__(self):
         super().__init__()
-        self.reuse_pool: Dict[
-            Any, List["FreeIfNotReusedLine"]
-        ] = collections.defaultdict(list)
-
-    def __contains__(self, key):
-        return bool(self.reuse_pool.get(key, None))
-
-    def pop(self, key) -> "FreeIfNotReusedLine":
-        item = self.reuse_pool[key].pop()
+        # planning runs after all buffers have been removed, so take one
+        # snapshot rather than going through V.graph for every line
+        self.removed_buffers = frozenset(V.graph.removed_buffers)
+        # bounded, so the oldest entries fall out and just get freed
+        self.reuse_pool: Dict[Any, Deque["FreeIfNotReusedLine"]] = {}
+        self.pool_size = config.reuse_pool_size
+
+    def try_pop(self, key) -> Optional["FreeIfNotReusedLine"]:
+        pool = self.reuse_pool.get(key)
+        if not pool:
+            return None
+        item = pool.pop()
         assert not item.is_reused
         return item
 
     def push(self, key, item: "FreeIfNotReusedLine"):
         assert not item.is_reused
-        self.reuse_pool[key].append(item)
+        pool = self.reuse_pool.get(key)
+        if pool is None:
+            pool = self.reuse_pool[key] = collections.deque(maxlen=self.pool_size)
+        pool.append(item)
 
 
 class MemoryPlanningLine:
+    __slots__ = ()
+
     def plan(self, state: MemoryPlanningState) -> "MemoryPlanningLine":
         """First pass to find reuse"""
         return self
 
-    def codegen(self, code: IndentedBuffer):
+    def codegen(self) -> List[str]:
         """Second pass to output code"""
-        pass
+        return []
 
 
-@dataclasses.dataclass
 class AllocateLine(MemoryPlanningLine):
-    node: ir.Buffer
+    __slots__ = ("node", "name")
+
+    def __init__(self, node: ir.Buffer):
+        self.node = node
+        self.name = node.get_name()
 
     def plan(self, state: MemoryPlanningState):
-        if self.node.get_name() in V.graph.removed_buffers:
+        if self.name in state.removed_buffers:
             return NullLine()
 
         # try to reuse a recently freed buffer
-        key = buffer_reuse_key(self.node)
-        if key in state:
-            free_line = state.pop(key)
+        free_line = state.try_pop(buffer_reuse_key(self.node))
+        if free_line is not None:
             free_line.is_reused = True
             return ReuseLine(free_line.node, self.node)
 
         return self
 
-    def codegen(self, code: IndentedBuffer):
-        assert self.node.get_name() not in V.graph.removed_buffers
-        code.writeline(make_buffer_allocation(self.node))
+    def codegen(self):
+        assert self.name not in V.graph.removed_buffers
+        return [make_buffer_allocation(self.node)]
 
 
-@dataclasses.dataclass
 class FreeIfNotReusedLine(MemoryPlanningLine):
-    node: ir.Buffer
-    is_reused: bool = False
+    __slots__ = ("node", "name", "is_reused")
+
+    def __init__(self, node: ir.Buffer, is_reused: bool = False):
+        self.node = node
+        self.name = node.get_name()
+        self.is_reused = is_reused
 
     def plan(self, state: MemoryPlanningState):
         assert not self.is_reused
-        if self.node.get_name() in V.graph.removed_buffers:
+        if self.name in state.removed_buffers:
             return NullLine()
-        state.push(buffer_reuse_key(self.node), self)
+        key = buffer_reuse_key(self.node)
+        if buffer_nbytes_hint(self.node) >= config.reuse_min_bytes:
+            state.push(key, self)
         return self
 
-    def codegen(self, code: IndentedBuffer):
-        assert self.node.get_name() not in V.graph.removed_buffers
-        if not self.is_reused:
-            code.writeline(f"del {self.node.get_name()}")
+    def codegen(self):
+        assert self.name not in V.graph.removed_buffers
+        if self.is_reused:
+            return []
+        return [f"del {self.name}"]
 
 
-@dataclasses.dataclass
 class ReuseLine(MemoryPlanningLine):
-    node: ir.Buffer
-    reused_as: ir.Buffer
+    __slots__ = ("node", "name", "reused_as", "reused_as_name")
+
+    def __init__(self, node: ir.Buffer, reused_as: ir.Buffer):
+        self.node = node
+        self.name = node.get_name()
+        self.reused_as = reused_as
+        self.reused_as_name = reused_as.get_name()
 
     def plan(self, state: MemoryPlanningState):
-        if self.reused_as.get_name() in V.graph.removed_buffers:
+        if self.reused_as_name in state.removed_buffers:
             # we hit this case only for inplace buffers
             return FreeLine(self.node).plan(state)
-        assert self.node.get_name() not in V.graph.removed_buffers
+        assert self.name not in state.removed_buffers
         return self
 
-    def codegen(self, code: IndentedBuffer):
-        assert self.node.get_name() not in V.graph.removed_buffers
-        assert self.reused_as.get_name() not in V.graph.removed_buffers
-        code.writeline(make_buffer_reuse(self.node, self.reused_as) + "  # reuse")
+    def codegen(self):
+        assert self.name not in V.graph.removed_buffers
+        assert self.reused_as_name not in V.graph.removed_buffers
+        return [make_buffer_reuse(self.node, self.reused_as) + "  # reuse"]
 
 
-@dataclasses.dataclass
 class FreeLine(MemoryPlanningLine):
-    node: ir.Buffer
+    __slots__ = ("node", "name")
+
+    def __init__(self, node: ir.Buffer):
+        self.node = node
+        self.name = node.get_name()
 
     def plan(self, state: MemoryPlanningState):
-        if self.node.get_name() in V.graph.removed_buffers:
+        if self.name in state.removed_buffers:
             return NullLine()
         return self
 
-    def codegen(self, code: IndentedBuffer):
-        assert self.node.get_name() not in V.graph.removed_buffers
-        code.writeline(f"del {self.node.get_name()}")
+    def codegen(self):
+        assert self.name not in V.graph.removed_buffers
+        return [f"del {self.name}"]
 
 
 class NullLine(MemoryPlanningLine):
-    pass
+    __slots__ = ()
+
+
+class NoReuseMemoryPlanningState(MemoryPlanningState):
+    """Only normalizes the lines, reuse is decided by MemoryColoringPlanner"""
+
+    def try_pop(self, key):
+        return None
+
+    def push(self, key, item: "FreeIfNotReusedLine"):
+        pass
+
+
+class ArenaAllocateLine(MemoryPlanningLine):
+    __slots__ = ("node", "name", "nbytes", "arena", "is_first")
+
+    def __init__(
+        self,
+        node: ir.Buffer,
+        nbytes: sympy.Expr,
+        arena: "MemoryArena",
+        is_first: bool,
+    ):
+        self.node = node
+        self.name = node.get_name()
+        self.nbytes = nbytes
+        self.arena = arena
+        self.is_first = is_first
+
+    def codegen(self):
+        assert self.name not in V.graph.removed_buffers
+        sizevars = V.graph.sizevars
+        nbytes = sizevars.codegen_sizevar(self.nbytes)
+        view = (
+            f"{self.name} = as_strided("
+            f"{self.arena.name}[:{nbytes}].view({self.node.get_dtype()}), "
+            f"{sizevars.codegen_shape_tuple(self.node.get_size())}, "
+            f"{sizevars.codegen_shape_tuple(self.node.get_stride())})"
+        )
+        if self.is_first:
+            return [make_arena_allocation(self.arena), view]
+        return [view]
+
+
+class ArenaFreeLine(MemoryPlanningLine):
+    __slots__ = ("node", "name", "arena", "is_last")
+
+    def __init__(self, node: ir.Buffer, arena: "MemoryArena", is_last: bool):
+        self.node = node
+        self.name = node.get_name()
+        self.arena = arena
+        self.is_last = is_last
+
+    def codegen(self):
+        assert self.name not in V.graph.removed_buffers
+        if self.is_last:
+            return [f"del {self.name}", f"del {self.arena.name}"]
+        return [f"del {self.name}"]
+
+
+@dataclasses.dataclass
+class BufferLifetime:
+    """
+    Storage of an allocated buffer, followed through any inplace ReuseLines
+    """
+
+    node: ir.Buffer
+    start: int
+    end: int = -1
+    free_node: Optional[ir.Buffer] = None
+    nbytes: sympy.Expr = sympy.Integer(0)
+
+    def overlaps(self, other: "BufferLifetime"):
+        return not (self.end < other.start or other.end < self.start)
+
+
+@dataclasses.dataclass
+class MemoryArena:
+    """A uint8 allocation shared by buffers of one color"""
+
+    name: str
+    device: torch.device
+    nbytes: sympy.Expr
+    members: List[BufferLifetime] = dataclasses.field(default_factory=list)
+    # the arena is reserved from its first member's start to its last's end
+    start: int = -1
+    end: int = -1
+
+    def add(self, lifetime: BufferLifetime):
+        if self.members:
+            self.start = min(self.start, lifetime.start)
+            self.end = max(self.end, lifetime.end)
+        else:
+            self.start, self.end = lifetime.start, lifetime.end
+        self.members.append(lifetime)
+
+    def idle_allocations(self, lifetime: BufferLifetime, allocations: List[int]):
+        """
+        Count the allocations that would happen while the arena is reserved
+        but not fully used, were lifetime to join it.  Each of those could
+        raise the peak over giving lifetime a buffer of its own.
+        """
+        idle = 0
+        if lifetime.start > self.end:
+            # the arena would stay reserved between its span and lifetime
+            idle += bisect.bisect_left(allocations, lifetime.start) - (
+                bisect.bisect_right(allocations, self.end)
+            )
+        elif lifetime.end < self.start:
+            idle += bisect.bisect_left(allocations, self.start) - (
+                bisect.bisect_right(allocations, lifetime.end)
+            )
+        if lifetime.nbytes != self.nbytes:
+            # the bytes lifetime leaves unused, including at its own allocation
+            idle += bisect.bisect_left(allocations, lifetime.end) - (
+                bisect.bisect_left(allocations, lifetime.start)
+            )
+        return idle
+
+    def can_hold(self, lifetime: BufferLifetime):
+        if self.device != lifetime.node.get_device():
+            return False
+        if any(lifetime.overlaps(m) for m in self.members):
+            return False
+        nbytes = lifetime.nbytes
+        if isinstance(self.nbytes, sympy.Integer) and isinstance(nbytes, sympy.Integer):
+            return bool(nbytes <= self.nbytes)
+        # only symbolic sizes need sympy to prove the buffer fits
+        slack = V.graph.sizevars.simplify(self.nbytes - nbytes)
+        return bool(slack.is_number and slack >= 0)
+
+
+def make_arena_allocation(arena: MemoryArena):
+    return (
+        f"{arena.name} = empty_strided("
+        f"{V.graph.sizevars.codegen_shape_tuple((arena.nbytes,))}, (1, ), "
+        f"device='{arena.device.type}', dtype=torch.uint8)"
+    )
+
+
+class MemoryColoringPlanner:
+    """
+    Alternative to the greedy MemoryPlanningState reuse, enabled with
+    config.memory_planning = "coloring".
+
+    Computes the lifetime of every buffer that is both allocated and freed
+    in the wrapper, then greedily colors the interval graph of those
+    lifetimes, largest buffers first.  Buffers of a color never overlap in
+    time, so they all become views into a single uint8 arena sized for the
+    largest member.  Unlike the exact-size reuse pool this lets buffers of
+    different dtypes and shapes share memory, and the allocator is called
+    once per arena rather than once per buffer.
+
+    An arena stays reserved from its first member's allocation to its last
+    member's free, so a buffer only joins one if no other allocation would
+    see the arena idle or partly unused.  That keeps the peak no higher
+    than allocating every buffer separately.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._names_iter = count()
+
+    def plan(self, lines: List[Any], planned: List[int]):
+        """Rewrite lines in place, planned holds the MemoryPlanningLine indices"""
+        planning_state = NoReuseMemoryPlanningState()
+        for i in planned:
+            lines[i] = lines[i].plan(planning_state)
+
+        allocations = [i for i in planned if isinstance(lines[i], AllocateLine)]
+        arenas = self.color(self.compute_lifetimes(lines, planned), allocations)
+        for arena in arenas:
+            if len(arena.members) < 2:
+                continue  # nothing shared, keep the plain allocation
+            arena.members.sort(key=lambda m: m.start)
+            for i, member in enumerate(arena.members):
+                lines[member.start] = ArenaAllocateLine(
+                    member.node, member.nbytes, arena, i == 0
+                )
+                lines[member.end] = ArenaFreeLine(
+                    member.free_node, arena, i == len(arena.members) - 1
+                )
+        return lines
+
+    @staticmethod
+    def compute_lifetimes(lines: List[Any], planned: List[int]) -> List[BufferLifetime]:
+        lifetimes = []
+        live = {}
+        for i in planned:
+            line = lines[i]
+            if isinstance(line, AllocateLine):
+                live[line.name] = BufferLifetime(line.node, i)
+            elif isinstance(line, ReuseLine):
+                lifetime = live.pop(line.name, None)
+                if lifetime is not None:
+                    live[line.reused_as_name] = lifetime
+            elif isinstance(line, (FreeIfNotReusedLine, FreeLine)):
+                lifetime = live.pop(line.name, None)
+                if lifetime is not None:
+                    lifetime.end = i
+                    lifetime.free_node = line.node
+                    lifetimes.append(lifetime)
+        # anything still in `live` is never freed (e.g. outputs)
+        return lifetimes
+
+    def color(
+        self, lifetimes: List[BufferLifetime], allocations: List[int]
+    ) -> List[MemoryArena]:
+        sizevars = V.graph.sizevars
+        for lifetime in lifetimes:
+            lifetime.nbytes = buffer_storage_nbytes(lifetime.node)
+        lifetimes = [x for x in lifetimes if x.nbytes != 0]
+        lifetimes.sort(key=lambda x: -sizevars.size_hint(x.nbytes))
+
+        arenas: List[MemoryArena] = []
+        for lifetime in lifetimes:
+            for arena in arenas:
+                if (
+                    arena.can_hold(lifetime)
+                    and arena.idle_allocations(lifetime, allocations) == 0
+                ):
+                    break
+            else:
+                arena = MemoryArena(
+                    f"arena{next(self._names_iter)}",
+                    lifetime.node.get_device(),
+                    lifetime.nbytes,
+                )
+                arenas.append(arena)
+            arena.add(lifetime)
+        return arenas
 
 
 class WrapperCodeGen(CodeGen):
@@ -175,67 +565,27 @@ class WrapperCodeGen(CodeGen):
         self.kernels = {}
         self.lines = []
         self.header.splice(
-            f"""
-                from ctypes import c_void_p, c_long
-                import torch
-                import random
-                from torch import empty_strided, as_strided, device
-                from {codecache.__name__} import CppCodeCache, TritonCodeCache
-
-                aten = torch.ops.aten
-
-            """
-        )
-
-        if has_triton():
-            self.header.splice(
-                """
-                    import triton
-                    import triton.language as tl
-
-                    from torchinductor.triton_ops.autotune import pointwise_heuristics
-                    from torchinductor.triton_ops.autotune import reduction_heuristics
-                    from torchinductor.triton_ops.autotune import grid
-
-                """
+            wrapper_header(
+                has_triton(),
+                config.triton.convolution != "aten",
+                config.triton.mm != "aten",
+                config.triton.use_bmm,
             )
-
-            if config.triton.convolution != "aten":
-                self.header.splice(
-                    """
-                    from torchinductor.triton_ops.conv_perf_model import early_config_prune
-                    from torchinductor.triton_ops.conv_perf_model import estimate_conv_time
-                    from torchinductor.triton_ops.autotune import conv_heuristics
-                    """
-                )
-
-            if config.triton.mm != "aten":
-                self.header.splice(
-                    """
-                    from torchinductor.triton_ops.autotune import mm_heuristics
-                    from torchinductor.triton_ops.autotune import mm_autotune
-                    """
-                )
-
-            if config.triton.use_bmm:
-                self.header.writeline(
-                    "from torchinductor.triton_ops.batched_matmul import bmm_out as triton_bmm_out"
-                )
+        )
 
         self.prefix.writelines(
             ["", "", f"def call({', '.join(V.graph.graph_inputs.keys())}):"]
         )
         with self.prefix.indent():
-            for name in V.graph.randomness_seeds:
-                self.prefix.writeline(
-                    f"torch.randint(2**31, size=(), dtype=torch.int64, out={name})"
-                )
+            self.prefix.writelines(
+                f"torch.randint(2**31, size=(), dtype=torch.int64, out={name})"
+                for name in V.graph.randomness_seeds
+            )
             V.graph.sizevars.codegen(self.prefix, V.graph.graph_inputs)
 
         for name, value in V.graph.constants.items():
             # include a hash so our code cache gives different constants different files
-            hashed = hashlib.sha256(repr(value).encode("utf-8")).hexdigest()
-            self.header.writeline(f"{name} = None  # {hashed}")
+            self.header.writeline(f"{name} = None  # {hash_constant(value)}")
 
         self.allocated = set()
         self.freed = set()
@@ -278,10 +628,11 @@ class WrapperCodeGen(CodeGen):
 
     def can_reuse(self, buffer):
         name = buffer.get_name()
+        graph = V.graph
         if (
-            name in V.graph.removed_buffers
-            or name in V.graph.graph_inputs
-            or name in V.graph.constants
+            name in graph.removed_buffers
+            or name in graph.graph_inputs
+            or name in graph.constants
             or name in self.freed
         ):
             return False
@@ -302,25 +653,41 @@ class WrapperCodeGen(CodeGen):
 
         out_names = V.graph.get_output_names()
         with result.indent():
-            while (
-                self.lines
-                and isinstance(self.lines[-1], MemoryPlanningLine)
-                and self.lines[-1].node.name not in out_names
-            ):
-                # these lines will be pointless
-                self.lines.pop()
-
-            # codegen allocations in two passes
-            planning_state = MemoryPlanningState()
-            for i in range(len(self.lines)):
-                if isinstance(self.lines[i], MemoryPlanningLine):
-                    self.lines[i] = self.lines[i].plan(planning_state)
-
-            for line in self.lines:
-                if isinstance(line, MemoryPlanningLine):
-                    line.codegen(result)
-                else:
-                    result.writeline(line)
+            # trailing memory planning lines will be pointless
+            lines = self.lines
+            cut = len(lines)
+            while cut:
+                line = lines[cut - 1]
+                if not isinstance(line, MemoryPlanningLine) or line.name in out_names:
+                    break
+                cut -= 1
+            del lines[cut:]
+
+            # codegen allocations in two passes, a FreeIfNotReusedLine only
+            # knows if it was reused once every later line has been planned.
+            # plan() always returns another MemoryPlanningLine, so the
+            # positions of planning lines only need to be found once.
+            planned = [
+                i
+                for i, line in enumerate(lines)
+                if isinstance(line, MemoryPlanningLine)
+            ]
+            if config.memory_planning == "coloring":
+                MemoryColoringPlanner().plan(lines, planned)
+            else:
+                planning_state = MemoryPlanningState()
+                for i in planned:
+                    lines[i] = lines[i].plan(planning_state)
+
+            # everything between planning lines is copied over in bulk
+            output = []
+            start = 0
+            for i in planned:
+                output.extend(lines[start:i])
+                output.extend(lines[i].codegen())
+                start = i + 1
+            output.extend(lines[start:])
+            result.writelines(output)
 
             output_refs = [x.codegen_reference() for x in V.graph.graph_outputs]
             if output_refs:
@@ -339,11 +706,13 @@ class WrapperCodeGen(CodeGen):
         if not config.benchmark_harness:
             return
 
-        def add_fake_input(name, shape, stride, device, dtype):
-            output.writeline(
+        sizevars = V.graph.sizevars
+
+        def make_fake_input(name, shape, stride, device, dtype):
+            return (
                 f"{name} = rand_strided("
-                f"{V.graph.sizevars.codegen_shape_tuple(shape)}, "
-                f"{V.graph.sizevars.codegen_shape_tuple(stride)}, "
+                f"{sizevars.codegen_shape_tuple(shape)}, "
+                f"{sizevars.codegen_shape_tuple(stride)}, "
                 f"device='{device.type}', dtype={dtype})"
             )
 
@@ -357,17 +726,22 @@ class WrapperCodeGen(CodeGen):
                 strip=True,
             )
 
-            for name, value in V.graph.constants.items():
-                add_fake_input(
+            output.writelines(
+                make_fake_input(
                     name, value.size(), value.stride(), value.device, value.dtype
                 )
-
-            for name, value in V.graph.graph_inputs.items():
-                shape = [V.graph.sizevars.size_hint(x) for x in value.get_size()]
-                stride = [V.graph.sizevars.size_hint(x) for x in value.get_stride()]
-                add_fake_input(
-                    name, shape, stride, value.get_device(), value.get_dtype()
+                for name, value in V.graph.constants.items()
+            )
+            output.writelines(
+                make_fake_input(
+                    name,
+                    [sizevars.size_hint(x) for x in value.get_size()],
+                    [sizevars.size_hint(x) for x in value.get_stride()],
+                    value.get_device(),
+                    value.get_dtype(),
                 )
+                for name, value in V.graph.graph_inputs.items()
+            )
 
             output.writeline(
                 f"print_performance(lambda: call({', '.join(V.graph.graph_inputs.keys())}))"
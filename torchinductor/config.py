@@ -21,6 +21,22 @@ pick_loop_orders = True
 # generate inplace computations
 inplace_buffers = False
 
+# how wrapper code reuses buffer memory:
+#   "greedy" reuses a freed buffer of the exact same size as it comes along
+#   "coloring" colors the graph of buffer lifetimes so that buffers of any
+#   size and dtype with disjoint lifetimes share one uint8 arena allocation
+memory_planning = "greedy"
+
+# (greedy) freed buffers smaller than this many bytes are not kept for reuse
+reuse_min_bytes = 4096
+
+# (greedy) max number of freed buffers kept per (device, dtype, size) key
+reuse_pool_size = 8
+
+# hash constants with sha256 over their full contents copied to the host,
+# instead of xxhash (if installed) and an on-device checksum for gpu tensors
+sha256_constant_hash = False
+
 # codegen benchmark harness
 benchmark_harness = True
 
@@ -50,6 +50,7 @@ class SizeVarAllocator(object):
         self.replacements: Dict[sympy.Symbol, Expr] = {}
         self.need_seed = False
         self.stride_vars = self.make_stride_vars_cache()
+        self.codegen_shape_tuple = self.make_codegen_shape_tuple_cache()
         if not zero_one_const:
             self.val_to_var.clear()
         self.simplify_with_ranges = self.make_simplify_with_ranges_cache()
@@ -399,7 +400,18 @@ class SizeVarAllocator(object):
         x = sympy.expand(x)
         return pexpr(x.subs(self.replacements))
 
-    def codegen_shape_tuple(self, shape: Tuple[Expr, ...]) -> str:
+    def make_codegen_shape_tuple_cache(self):
+        """
+        Many buffers share the same sizes/strides, cache the printed tuples
+        """
+        cache = self._lru_cache(self._codegen_shape_tuple)
+
+        def codegen_shape_tuple(shape: Tuple[Expr, ...]) -> str:
+            return cache(tuple(shape))
+
+        return codegen_shape_tuple
+
+    def _codegen_shape_tuple(self, shape: Tuple[Expr, ...]) -> str:
         parts = list(map(self.codegen_sizevar, shape))
         if len(parts) == 0:
             return "()"